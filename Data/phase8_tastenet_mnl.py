@@ -22,8 +22,8 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
 
@@ -48,7 +48,7 @@ class TasteNet(nn.Module):
         for hidden_dim in hidden_dims:
             layers.append(nn.Linear(prev_dim, hidden_dim))
             layers.append(nn.ReLU())
-            layers.append(nn.BatchNorm1d(hidden_dim))
+            layers.append(nn.LayerNorm(hidden_dim))  # per-sample, no batch statistics
             layers.append(nn.Dropout(0.2))
             prev_dim = hidden_dim
 
@@ -64,6 +64,11 @@ class TasteNet(nn.Module):
 # 2. TasteNet-MNL Model
 # ============================================================================
 
+# Choice set layout (see TasteNetMNL): SE and branch alternatives
+SE_ALTS = [1, 4, 7]
+BRANCH_ALTS = [6, 7, 8]
+
+
 class TasteNetMNL(nn.Module):
     """
     Multinomial Logit with TasteNet for heterogeneous taste parameters.
@@ -77,16 +82,18 @@ class TasteNetMNL(nn.Module):
         super(TasteNetMNL, self).__init__()
 
         self.n_alternatives = n_alternatives
+        self.x_dim = x_dim
 
-        # Alternative-specific parameters (beta)
-        self.beta = nn.Parameter(torch.randn(x_dim, n_alternatives - 1) * 0.01)
-
-        # Infrastructure parameters (delta)
-        self.delta = nn.Parameter(torch.randn(z_dim, n_alternatives - 1) * 0.01)
+        # Stacked linear utility parameters theta = [beta; delta], so that
+        # X @ beta + Z @ delta is a single [X, Z] @ theta matmul
+        self.theta = nn.Parameter(torch.randn(x_dim + z_dim, n_alternatives - 1) * 0.01)
 
         # TasteNet for heterogeneous credit access sensitivity
         self.tastenet = TasteNet(x_dim, hidden_dims=tastenet_hidden, output_dim=1)
 
+        # Columns of V that receive the credit term (SE alternatives)
+        self.register_buffer('se_cols', torch.tensor(SE_ALTS), persistent=False)
+
         # Credit access indicator for each alternative (fixed)
         # Assumes: alternatives 0-2 = Unbanked x {Wage, SE, NotWork}
         #          alternatives 3-5 = Mobile x {Wage, SE, NotWork}
@@ -94,86 +101,252 @@ class TasteNetMNL(nn.Module):
         # SE alternatives: 1, 4, 7
         # Branch alternatives: 6, 7, 8
 
-    def forward(self, X, Z, credit_access, se_indicator):
+    @property
+    def beta(self):
+        """Alternative-specific parameters [x_dim, n_alt-1] (view of theta)"""
+        return self.theta[:self.x_dim]
+
+    @property
+    def delta(self):
+        """Infrastructure parameters [z_dim, n_alt-1] (view of theta)"""
+        return self.theta[self.x_dim:]
+
+    def precompute_base(self, XZ, tastenet_dtype=None):
         """
-        X: Individual demographics [batch, x_dim]
-        Z: CBSA infrastructure [batch, z_dim]
-        credit_access: Credit access level by alternative [batch, n_alt]
-        se_indicator: 1 if alternative is self-employment [batch, n_alt]
+        Credit-independent part of the utilities.
+
+        Returns: V_static [batch, n_alternatives] (X @ beta + Z @ delta, zero
+        for the base alternative), gamma_i [batch, 1]
+
+        V = V_static + gamma_i * credit_se on the SE alternatives, so for fixed
+        XZ these can be cached and reused across credit scenarios.
 
-        Returns: Log-probabilities [batch, n_alternatives]
+        tastenet_dtype: if given (e.g. torch.bfloat16), only the TasteNet call
+        runs under autocast to this dtype; the utility matmul stays in the
+        dtype of XZ and gamma_i is cast back to it.
         """
-        batch_size = X.shape[0]
+        batch_size = XZ.shape[0]
+        X = XZ[:, :self.x_dim]  # Individual demographics [batch, x_dim]
 
-        # Base utility from demographics
-        V_base = X @ self.beta  # [batch, n_alt-1]
-        V_base = torch.cat([torch.zeros(batch_size, 1), V_base], dim=1)  # Add base alt
+        # Utility matrix; column 0 is the base alternative (V = 0).
+        # Allocated per call on purpose: a persistent buffer written in place
+        # would be overwritten while autograd still needs it. When the
+        # training step is captured as a CUDA graph (see train_tastenet_mnl),
+        # the graph's static memory pool reuses this allocation anyway.
+        V = XZ.new_zeros(batch_size, self.n_alternatives)  # [batch, n_alt]
 
-        # Infrastructure utility
-        V_infra = Z @ self.delta  # [batch, n_alt-1]
-        V_infra = torch.cat([torch.zeros(batch_size, 1), V_infra], dim=1)
+        # Base utility from demographics + infrastructure utility
+        # (X @ beta + Z @ delta), written directly into the non-base columns
+        V[:, 1:] = XZ @ self.theta  # [batch, n_alt-1]
 
         # TasteNet: individual-specific branch sensitivity
-        gamma_i = self.tastenet(X)  # [batch, 1]
+        if tastenet_dtype is None:
+            gamma_i = self.tastenet(X)  # [batch, 1]
+        else:
+            with torch.autocast(device_type=XZ.device.type, dtype=tastenet_dtype):
+                gamma_i = self.tastenet(X).to(XZ.dtype)
 
-        # Credit access effect: only for SE alternatives
-        V_credit = gamma_i * credit_access * se_indicator  # [batch, n_alt]
+        return V, gamma_i
+
+    def forward(self, XZ, credit_se):
+        """
+        XZ: [X, Z] - demographics and CBSA infrastructure, see prepare_inputs()
+            [batch, x_dim + z_dim]
+        credit_se: credit_access * se_indicator on the SE alternatives,
+            see prepare_inputs() [batch, len(SE_ALTS)]
 
-        # Total utility
-        V = V_base + V_infra + V_credit
+        Returns: Utilities V [batch, n_alternatives], gamma_i [batch, 1]
 
-        # Log-softmax for numerical stability
-        log_probs = torch.log_softmax(V, dim=1)
+        V is returned unnormalized; the softmax is applied by F.cross_entropy
+        during training and by predict_proba().
+        """
+        V, gamma_i = self.precompute_base(XZ)
+
+        # Credit access effect: only for SE alternatives
+        V.index_add_(1, self.se_cols, gamma_i * credit_se)  # [batch, n_alt]
 
-        return log_probs, gamma_i
+        return V, gamma_i
 
-    def predict_proba(self, X, Z, credit_access, se_indicator):
+    def predict_proba(self, XZ, credit_se):
         """Return choice probabilities"""
         with torch.no_grad():
-            log_probs, _ = self.forward(X, Z, credit_access, se_indicator)
-            return torch.exp(log_probs)
+            V, _ = self.forward(XZ, credit_se)
+            return torch.softmax(V, dim=1)
+
+
+def prepare_inputs(X, Z, credit_access, se_indicator):
+    """
+    Build the model inputs once per dataset.
+
+    Returns: XZ = [X, Z] [n, x_dim + z_dim], the input of the single
+    utility matmul, and credit_se = credit_access * se_indicator restricted
+    to the SE alternatives [n, len(SE_ALTS)], the credit term of V (zero on
+    every other alternative). Both are fixed per observation, so they are
+    computed here rather than on every forward pass.
+
+    Raises ValueError if the data does not match the SE_ALTS layout, i.e.
+    fewer alternatives than max(SE_ALTS) + 1 or a nonzero credit term on a
+    non-SE alternative (which the model would otherwise silently drop).
+    """
+    n_alternatives = credit_access.shape[1]
+    if n_alternatives <= max(SE_ALTS):
+        raise ValueError(f"Expected more than {max(SE_ALTS)} alternatives "
+                         f"(SE alternatives {SE_ALTS}), got {n_alternatives}")
+
+    credit_se_full = credit_access.mul(se_indicator)
+    non_se = [j for j in range(n_alternatives) if j not in SE_ALTS]
+    if credit_se_full[:, non_se].any():
+        raise ValueError(f"credit_access * se_indicator is nonzero outside the "
+                         f"SE alternatives {SE_ALTS}; check the choice encoding")
+
+    XZ = torch.cat([X, Z], dim=1)
+    credit_se = credit_se_full[:, SE_ALTS]
+    return XZ, credit_se
 
 
 # ============================================================================
 # 3. Training Loop
 # ============================================================================
 
-def train_tastenet_mnl(model, train_loader, val_loader, epochs=100, lr=0.001):
+def split_data(XZ, credit_se, y, val_size=0.2, device='cpu'):
+    """
+    Split tensors into train/validation sets resident on `device`.
+
+    The full dataset is small enough to live on the device, so training
+    indexes minibatches directly instead of going through a DataLoader.
+    """
+    idx_train, idx_val = train_test_split(np.arange(len(y)), test_size=val_size,
+                                          random_state=42)
+    idx_train = torch.as_tensor(idx_train)
+    idx_val = torch.as_tensor(idx_val)
+
+    train_data = tuple(t[idx_train].to(device) for t in (XZ, credit_se, y))
+    val_data = tuple(t[idx_val].to(device) for t in (XZ, credit_se, y))
+
+    return train_data, val_data
+
+
+def train_tastenet_mnl(model, train_data, val_data, epochs=100, lr=0.001,
+                       batch_size=256, save_path=None):
     """
     Train TasteNet-MNL with early stopping.
+
+    train_data, val_data: (XZ, credit_se, y) tuples on the model's device,
+    see split_data(). Each epoch draws minibatches from a random permutation;
+    the last partial batch is dropped to keep shapes static. If the training
+    split is smaller than batch_size, each epoch is a single full batch.
+
+    The best weights are kept in memory; if save_path is given they are
+    written to disk once after training.
+
+    On CUDA the forward pass runs under mixed-precision autocast: BF16 where
+    supported (same exponent range as FP32, no loss scaling), otherwise FP16
+    with a GradScaler.
+
+    With BF16 on CUDA the whole training step (forward, backward, Adam
+    update) is captured once into a CUDA graph and replayed per minibatch,
+    removing per-step Python and kernel-launch overhead. Because the data is
+    already on the device, the only static input is the minibatch index
+    tensor. The FP16/GradScaler and CPU paths run the step eagerly.
     """
-    optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=1e-5)
+    # Mixed precision (CUDA only)
+    device = next(model.parameters()).device
+    use_amp = device.type == 'cuda'
+    if use_amp and torch.cuda.is_bf16_supported():
+        amp_dtype = torch.bfloat16
+    else:
+        amp_dtype = torch.float16
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp and amp_dtype == torch.float16)
+
+    # GradScaler syncs with the host, so it cannot run inside a graph
+    use_graph = use_amp and not scaler.is_enabled()
+
+    # Single-launch Adam update: fused kernel on CUDA, foreach on CPU
+    adam_impl = dict(fused=True) if use_amp else dict(foreach=True)
+    if use_graph:
+        # Capturable Adam with a device lr tensor, so lr changes from the
+        # scheduler are seen by graph replays
+        optimizer = optim.Adam(model.parameters(), lr=torch.tensor(lr, device=device),
+                               weight_decay=1e-5, capturable=True, **adam_impl)
+    else:
+        optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=1e-5, **adam_impl)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=10)
-    criterion = nn.NLLLoss()
+    lr_t = optimizer.param_groups[0]['lr']
+
+    XZ_train, credit_se_train, y_train = train_data
+    XZ_val, credit_se_val, y_val = val_data
+    n_train = len(y_train)
+    batch_size = min(batch_size, n_train)  # small samples: one full batch
+    n_batches = n_train // batch_size
+
+    def train_step(idx):
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp,
+                            cache_enabled=False):
+            V, _ = model(XZ_train[idx], credit_se_train[idx])
+            loss = F.cross_entropy(V, y_train[idx])
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        return loss.detach()
+
+    if use_graph:
+        model.train()
+        static_idx = torch.randperm(n_train, device=device)[:batch_size]
+
+        # Warm up on a side stream (these are regular training steps)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                optimizer.zero_grad(set_to_none=True)
+                train_step(static_idx)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Capture; gradients are allocated from the graph's pool and
+        # overwritten (not accumulated) on every replay
+        optimizer.zero_grad(set_to_none=True)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_loss = train_step(static_idx)
+
+    # Unwrap torch.compile so checkpoint keys match a plain TasteNetMNL
+    base_model = getattr(model, '_orig_mod', model)
 
     best_val_loss = float('inf')
+    best_state = None
     patience_counter = 0
 
     for epoch in range(epochs):
         # Training
         model.train()
-        train_loss = 0
-        for X, Z, credit, se_ind, y in train_loader:
-            optimizer.zero_grad()
-            log_probs, _ = model(X, Z, credit, se_ind)
-            loss = criterion(log_probs, y)
-            loss.backward()
-            optimizer.step()
-            train_loss += loss.item()
-
-        # Validation
+        train_loss = torch.zeros((), device=device)
+        perm = torch.randperm(n_train, device=device)
+        for b in range(n_batches):
+            idx = perm[b * batch_size:(b + 1) * batch_size]
+
+            if use_graph:
+                static_idx.copy_(idx)
+                graph.replay()
+                train_loss += static_loss
+            else:
+                optimizer.zero_grad(set_to_none=True)
+                train_loss += train_step(idx)
+
+        # Validation (single full-batch pass)
         model.eval()
-        val_loss = 0
         with torch.no_grad():
-            for X, Z, credit, se_ind, y in val_loader:
-                log_probs, _ = model(X, Z, credit, se_ind)
-                loss = criterion(log_probs, y)
-                val_loss += loss.item()
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                V, _ = model(XZ_val, credit_se_val)
+                val_loss = F.cross_entropy(V, y_val).item()
 
-        train_loss /= len(train_loader)
-        val_loss /= len(val_loader)
+        train_loss = train_loss.item() / n_batches
 
         scheduler.step(val_loss)
+        if use_graph and optimizer.param_groups[0]['lr'] is not lr_t:
+            # Scheduler replaced the lr tensor with a float; write it back
+            # into the tensor the captured graph reads
+            lr_t.fill_(optimizer.param_groups[0]['lr'])
+            optimizer.param_groups[0]['lr'] = lr_t
 
         if epoch % 10 == 0:
             print(f"Epoch {epoch}: Train Loss = {train_loss:.4f}, Val Loss = {val_loss:.4f}")
@@ -182,15 +355,22 @@ def train_tastenet_mnl(model, train_loader, val_loader, epochs=100, lr=0.001):
         if val_loss < best_val_loss:
             best_val_loss = val_loss
             patience_counter = 0
-            torch.save(model.state_dict(), 'best_tastenet_mnl.pt')
+            best_state = {k: v.detach().clone() for k, v in base_model.state_dict().items()}
         else:
             patience_counter += 1
             if patience_counter >= 20:
                 print(f"Early stopping at epoch {epoch}")
                 break
 
-    # Load best model
-    model.load_state_dict(torch.load('best_tastenet_mnl.pt'))
+    # Restore best model
+    if best_state is None:
+        # Validation loss never improved (e.g. NaN); keep the final weights
+        print("Warning: validation loss never improved; keeping final weights")
+        best_state = base_model.state_dict()
+    else:
+        base_model.load_state_dict(best_state)
+    if save_path is not None:
+        torch.save(best_state, save_path)
     return model
 
 
@@ -198,46 +378,184 @@ def train_tastenet_mnl(model, train_loader, val_loader, epochs=100, lr=0.001):
 # 4. Analyze Learned Taste Heterogeneity
 # ============================================================================
 
-def analyze_taste_heterogeneity(model, X, feature_names):
+def kmeans_1d_prefix(sorted_values):
+    """
+    Prefix sums over the distinct values of an ascending 1-D array.
+
+    Returns: (uniq, cw, cs, cs2, shift) with uniq the distinct values, cw,
+    cs, cs2 the cumulative count, sum and sum of squares (leading 0) of the
+    values centered at their mean `shift`, which limits cancellation in the
+    SSE.
+    """
+    x = np.asarray(sorted_values, dtype=float)
+    shift = x.mean()
+    u = x - shift
+
+    # The input is sorted, so distinct values end where the next one differs
+    ends = np.flatnonzero(np.append(x[1:] != x[:-1], True)) + 1
+    uniq = x[ends - 1]
+    cw = np.concatenate([[0], ends])
+    cs = np.concatenate([[0.0], np.cumsum(u)[ends - 1]])
+    cs2 = np.concatenate([[0.0], np.cumsum(u * u)[ends - 1]])
+    return uniq, cw, cs, cs2, shift
+
+
+def kmeans_1d_all(sorted_values, ks):
+    """
+    Exact (globally optimal) k-means for 1-D data, for several k at once.
+
+    In 1-D every optimal cluster is a contiguous run of sorted values, so the
+    optimal partition follows from the DP
+        cost_c[i] = min_j cost_{c-1}[j] + sse(j, i)
+    over the distinct values, with sse read off prefix sums in O(1). The
+    optimal split point is monotone in i, so each layer is solved by divide
+    and conquer in O(m log m) for m distinct values, one recursion level at
+    a time: all nodes of a level are evaluated in a single vectorized pass
+    (O(log m) numpy passes per layer).
+
+    The DP runs once, up to max(ks) - 1 full layers; every k then needs one
+    O(m) argmin for the full sample plus a backtrack through the shared
+    layers. Ties are merged before the DP, so every cluster is non-empty and
+    centers are strictly increasing; if there are fewer than k distinct
+    values, one cluster per value is returned.
+
+    sorted_values: ascending 1-D array
+    ks: cluster counts to fit
+
+    Returns: {k: (centers [<= k] (ascending), counts [<= k] (cluster sizes))}
+    """
+    uniq, cw, cs, cs2, shift = kmeans_1d_prefix(sorted_values)
+    m = len(uniq)
+
+    def sse(j, i):
+        # Within-cluster SSE of distinct values uniq[j:i] (elementwise)
+        cnt = cw[i] - cw[j]
+        s = cs[i] - cs[j]
+        return (cs2[i] - cs2[j]) - s * s / cnt
+
+    # costs[c][i]: best SSE of the first i distinct values in c clusters;
+    # splits[c][i]: start of the last of those clusters
+    cost = np.full(m + 1, np.inf)
+    cost[1:] = sse(0, np.arange(1, m + 1))
+    costs = {1: cost}
+    splits = {}
+
+    for c in range(2, min(max(ks), m)):
+        new_cost = np.full(m + 1, np.inf)
+        split = np.zeros(m + 1, dtype=int)
+
+        # Divide-and-conquer nodes of the current level: rows lo..hi with
+        # candidate splits j_lo..j_hi
+        lo, hi = np.array([c]), np.array([m])
+        j_lo, j_hi = np.array([c - 1]), np.array([m - 1])
+        while len(lo):
+            i = (lo + hi) // 2
+            lengths = np.minimum(i - 1, j_hi) - j_lo + 1
+            starts = np.cumsum(lengths) - lengths
+
+            # Ragged candidate ranges of all nodes, flattened
+            pos = np.arange(starts[-1] + lengths[-1])
+            js = pos + np.repeat(j_lo - starts, lengths)
+            cand = cost[js] + sse(js, np.repeat(i, lengths))
+
+            # First argmin per node
+            best_cost = np.minimum.reduceat(cand, starts)
+            first = np.where(cand == np.repeat(best_cost, lengths), pos, len(pos))
+            best_j = js[np.minimum.reduceat(first, starts)]
+            new_cost[i] = best_cost
+            split[i] = best_j
+
+            # Children: left rows take splits <= best_j, right rows >= best_j
+            lo, hi = np.concatenate([lo, i + 1]), np.concatenate([i - 1, hi])
+            j_lo = np.concatenate([j_lo, best_j])
+            j_hi = np.concatenate([best_j, j_hi])
+            keep = lo <= hi
+            lo, hi, j_lo, j_hi = lo[keep], hi[keep], j_lo[keep], j_hi[keep]
+
+        cost = new_cost
+        costs[c] = cost
+        splits[c] = split
+
+    results = {}
+    for k in ks:
+        k_eff = min(k, m)
+
+        # Backtrack the cluster boundaries (indices into uniq); the last
+        # cluster only needs the full sample, a single argmin
+        bounds = [m]
+        if k_eff > 1:
+            js = np.arange(k_eff - 1, m)
+            bounds.append(js[np.argmin(costs[k_eff - 1][js] + sse(js, m))])
+            for c in range(k_eff - 1, 1, -1):
+                bounds.append(splits[c][bounds[-1]])
+        bounds.append(0)
+        bounds = np.array(bounds[::-1])
+
+        counts = cw[bounds[1:]] - cw[bounds[:-1]]
+        centers = (cs[bounds[1:]] - cs[bounds[:-1]]) / counts + shift
+        results[k] = (centers, counts)
+
+    return results
+
+
+def kmeans_1d(sorted_values, k):
+    """
+    Exact 1-D k-means for a single k, see kmeans_1d_all().
+
+    Returns: centers [<= k] (ascending), counts [<= k] (cluster sizes)
+    """
+    return kmeans_1d_all(sorted_values, [k])[k]
+
+
+def analyze_taste_heterogeneity(model, X, feature_names, bf16=True):
     """
     Analyze the learned gamma_C(X) function from TasteNet.
+
+    With bf16=True, gamma_i is evaluated under BF16 autocast. This is faster,
+    but BF16 keeps only 8 significant bits (2-3 decimal digits): the
+    printed percentiles and centers are only that precise, and many gamma_i
+    tie after rounding (on the order of 1-2k distinct values out of 10k),
+    so some of the structure the k-means check sees is rounding rather than
+    discrete types. Pass bf16=False to evaluate in FP32 when that matters.
     """
     model.eval()
-    with torch.no_grad():
-        gamma_i = model.tastenet(X).numpy().flatten()
+    with torch.no_grad(), torch.autocast(device_type=X.device.type, dtype=torch.bfloat16,
+                                         enabled=bf16):
+        gamma_i = model.tastenet(X).float().cpu().numpy().flatten()
 
     print("\n" + "="*60)
     print("LEARNED TASTE HETEROGENEITY")
     print("="*60)
 
+    # Sort once; min, max and percentiles are read off the sorted array
+    sorted_g = np.sort(gamma_i)
+    n = len(sorted_g)
+
     # Distribution of learned coefficients
     print(f"\nDistribution of gamma_C(X_i):")
-    print(f"  Mean:   {np.mean(gamma_i):.4f}")
-    print(f"  Std:    {np.std(gamma_i):.4f}")
-    print(f"  Min:    {np.min(gamma_i):.4f}")
-    print(f"  Max:    {np.max(gamma_i):.4f}")
+    print(f"  Mean:   {gamma_i.mean():.4f}")
+    print(f"  Std:    {gamma_i.std():.4f}")
+    print(f"  Min:    {sorted_g[0]:.4f}")
+    print(f"  Max:    {sorted_g[-1]:.4f}")
 
-    # Percentiles
+    # Percentiles (linear interpolation, as in np.percentile)
     percentiles = [5, 10, 25, 50, 75, 90, 95]
+    ranks = np.array(percentiles) / 100 * (n - 1)
+    values = np.interp(ranks, np.arange(n), sorted_g)
     print(f"\nPercentiles:")
-    for p in percentiles:
-        val = np.percentile(gamma_i, p)
+    for p, val in zip(percentiles, values):
         print(f"  {p}th: {val:.4f}")
 
     # Check for clustering (comparison to finite mixture)
-    from sklearn.cluster import KMeans
-
+    # One sort and one DP shared by all k
     print(f"\nK-Means Clustering (checking for discrete types):")
-    for k in [2, 3, 4, 5]:
-        kmeans = KMeans(n_clusters=k, random_state=42)
-        labels = kmeans.fit_predict(gamma_i.reshape(-1, 1))
-
-        # Compute cluster centers and shares
-        centers = kmeans.cluster_centers_.flatten()
-        shares = [np.mean(labels == i) for i in range(k)]
+    fits = kmeans_1d_all(sorted_g, [2, 3, 4, 5])
+    for k, (centers, counts) in fits.items():
+        # Cluster shares
+        shares = counts / n
 
         print(f"\n  K={k}:")
-        for i in range(k):
+        for i in range(len(centers)):
             print(f"    Type {i+1}: center={centers[i]:.4f}, share={shares[i]*100:.1f}%")
 
     return gamma_i
@@ -247,28 +565,54 @@ def analyze_taste_heterogeneity(model, X, feature_names):
 # 5. Counterfactual Analysis
 # ============================================================================
 
-def counterfactual_analysis(model, X, Z, credit_access, se_indicator,
-                            closure_rate=0.5):
+def counterfactual_base(model, XZ):
+    """
+    Credit-independent utilities (V_static, gamma_i) for counterfactual_analysis.
+
+    Runs model.precompute_base(XZ) in eval mode under no_grad. Only the
+    TasteNet layers run in BF16; the XZ @ theta utilities, the credit term
+    and the softmax stay in FP32. Compute it once and pass it as `base` to
+    sweep several closure rates; the results are identical to calls without
+    `base`.
+    """
+    model.eval()
+    with torch.no_grad():
+        return model.precompute_base(XZ, tastenet_dtype=torch.bfloat16)
+
+
+def counterfactual_analysis(model, XZ, credit_se, closure_rate=0.5, base=None):
     """
     Compute counterfactual SE rate under branch closure.
 
-    For branch users, reduce credit_access by closure_rate.
+    For branch users, reduce credit access by closure_rate. Only the credit
+    term of V changes, so the baseline utilities and gamma_i are reused and
+    the TasteNet forward pass runs once, see counterfactual_base().
+
+    base: optional counterfactual_base(model, XZ). Pass it when sweeping
+    several closure rates on the same XZ; each call is then purely
+    elementwise.
     """
     model.eval()
 
     with torch.no_grad():
+        if base is None:
+            base = counterfactual_base(model, XZ)
+        V_static, gamma_i = base
+
         # Baseline
-        probs_base = model.predict_proba(X, Z, credit_access, se_indicator)
-        se_alts = [1, 4, 7]  # SE alternatives
-        se_rate_base = probs_base[:, se_alts].sum(dim=1).mean().item()
+        V_base = V_static.index_add(1, model.se_cols, gamma_i * credit_se)
+        probs_base = torch.softmax(V_base, dim=1)
+        se_rate_base = probs_base[:, SE_ALTS].sum(dim=1).mean().item()
 
-        # Counterfactual: reduce branch credit access
-        credit_cf = credit_access.clone()
-        branch_alts = [6, 7, 8]
-        credit_cf[:, branch_alts] *= (1 - closure_rate)
+        # Counterfactual: reduce branch credit access,
+        # V_cf = V_base - closure_rate * gamma_i * credit_se (branch SE alts only)
+        branch_se = [i for i, alt in enumerate(SE_ALTS) if alt in BRANCH_ALTS]
+        branch_idx = torch.tensor([SE_ALTS[i] for i in branch_se], device=V_base.device)
+        V_cf = V_base.index_add(1, branch_idx, gamma_i * credit_se[:, branch_se],
+                                alpha=-closure_rate)
 
-        probs_cf = model.predict_proba(X, Z, credit_cf, se_indicator)
-        se_rate_cf = probs_cf[:, se_alts].sum(dim=1).mean().item()
+        probs_cf = torch.softmax(V_cf, dim=1)
+        se_rate_cf = probs_cf[:, SE_ALTS].sum(dim=1).mean().item()
 
         effect = (se_rate_cf - se_rate_base) / se_rate_base * 100
 
@@ -317,7 +661,10 @@ if __name__ == "__main__":
 
     # SE indicator
     se_indicator = torch.zeros(n_obs, n_alternatives)
-    se_indicator[:, [1, 4, 7]] = 1.0  # SE alternatives
+    se_indicator[:, SE_ALTS] = 1.0  # SE alternatives
+
+    # Model inputs are built once for the whole dataset
+    XZ, credit_se = prepare_inputs(X, Z, credit_access, se_indicator)
 
     # Initialize model
     model = TasteNetMNL(n_alternatives, x_dim, z_dim, tastenet_hidden=[32, 16])
@@ -325,10 +672,21 @@ if __name__ == "__main__":
     print(f"\nModel architecture:")
     print(model)
 
+    # Compiled model for the estimation run below (this demo does not fit
+    # it): fuses the TasteNet MLP and MNL head into a few kernels.
+    # train_tastenet_mnl draws fixed-size batches from a per-epoch
+    # permutation and drops the partial one, so shapes are static and
+    # Inductor can specialize. Default mode: train_tastenet_mnl captures the
+    # whole training step as a CUDA graph itself, which would conflict with
+    # "reduce-overhead".
+    model = torch.compile(model, fullgraph=True, dynamic=False)
+
     print("\nTo run full estimation:")
     print("1. Load analysis_dataset_with_se.dta")
     print("2. Create choice variable (1-9)")
-    print("3. Prepare X, Z, credit_access, se_indicator tensors")
-    print("4. Call train_tastenet_mnl()")
+    print("3. Prepare XZ, credit_se = prepare_inputs(X, Z, credit_access, se_indicator)")
+    print("4. Move data to the device with split_data() and call")
+    print("   train_tastenet_mnl() on the compiled model")
     print("5. Analyze heterogeneity with analyze_taste_heterogeneity()")
-    print("6. Compute counterfactuals with counterfactual_analysis()")
+    print("6. Compute counterfactuals with counterfactual_analysis(); for a sweep")
+    print("   over closure rates pass base=counterfactual_base(model, XZ)")
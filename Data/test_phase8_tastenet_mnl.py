@@ -0,0 +1,142 @@
+"""
+Regression tests for phase8_tastenet_mnl.py: the 1-D k-means, the
+TasteNet-MNL utilities against the original formulation, counterfactuals
+and a CPU training smoke test.
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from phase8_tastenet_mnl import (
+    BRANCH_ALTS, SE_ALTS, TasteNetMNL, counterfactual_analysis,
+    counterfactual_base, kmeans_1d, kmeans_1d_all, prepare_inputs,
+    split_data, train_tastenet_mnl,
+)
+
+N_ALTERNATIVES = 9
+
+
+def make_data(n=500, x_dim=5, z_dim=3, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    X = torch.randn(n, x_dim, generator=g)
+    Z = torch.randn(n, z_dim, generator=g)
+    credit_access = torch.rand(n, N_ALTERNATIVES, generator=g)
+    se_indicator = torch.zeros(n, N_ALTERNATIVES)
+    se_indicator[:, SE_ALTS] = 1
+    y = torch.randint(0, N_ALTERNATIVES, (n,), generator=g)
+    return X, Z, credit_access, se_indicator, y
+
+
+def make_model(x_dim=5, z_dim=3, seed=0):
+    torch.manual_seed(seed)
+    model = TasteNetMNL(N_ALTERNATIVES, x_dim, z_dim)
+    with torch.no_grad():
+        model.theta.normal_(0, 0.3)  # away from ~0 so differences show up
+    return model.eval()
+
+
+def reference_utilities(model, X, Z, credit_access, se_indicator):
+    """Original formulation: separate beta/delta terms on the full matrices."""
+    n = X.shape[0]
+    zeros = torch.zeros(n, 1)
+    V_x = torch.cat([zeros, X @ model.beta], dim=1)
+    V_z = torch.cat([zeros, Z @ model.delta], dim=1)
+    gamma_i = model.tastenet(X)
+    return V_x + V_z + gamma_i * credit_access * se_indicator, gamma_i
+
+
+def test_kmeans_1d_heavy_ties():
+    x = np.sort([-0.01] * 21 + [0, 0, 0, 0.01])
+    centers, counts = kmeans_1d(x, 5)
+
+    # Only 3 distinct values: one cluster each, none empty or negative
+    np.testing.assert_allclose(centers, [-0.01, 0.0, 0.01], atol=1e-12)
+    np.testing.assert_array_equal(counts, [21, 3, 1])
+
+
+def test_kmeans_1d_matches_known_partition():
+    x = np.sort([0.0] * 10 + [1.0] * 10 + [5.0] * 5)
+    centers, counts = kmeans_1d(x, 3)
+
+    np.testing.assert_allclose(centers, [0.0, 1.0, 5.0], atol=1e-12)
+    np.testing.assert_array_equal(counts, [10, 10, 5])
+
+
+def test_kmeans_1d_valid_clusters_with_ties():
+    rng = np.random.default_rng(0)
+    x = np.sort(np.round(rng.normal(size=2000), 1))  # many tied values
+    fits = kmeans_1d_all(x, [2, 3, 4, 5])
+
+    for k, (centers, counts) in fits.items():
+        assert len(centers) == k
+        assert (counts > 0).all()
+        assert counts.sum() == len(x)
+        assert (np.diff(centers) > 0).all()
+
+
+def test_forward_matches_reference():
+    X, Z, credit_access, se_indicator, y = make_data()
+    model = make_model()
+    XZ, credit_se = prepare_inputs(X, Z, credit_access, se_indicator)
+
+    with torch.no_grad():
+        V, gamma_i = model(XZ, credit_se)
+        V_ref, gamma_ref = reference_utilities(model, X, Z, credit_access, se_indicator)
+
+    torch.testing.assert_close(gamma_i, gamma_ref, rtol=0, atol=1e-6)
+    torch.testing.assert_close(V, V_ref, rtol=0, atol=1e-5)
+    torch.testing.assert_close(torch.log_softmax(V, dim=1),
+                               torch.log_softmax(V_ref, dim=1), rtol=0, atol=1e-5)
+
+
+def test_counterfactual_base_reuse_and_reference():
+    X, Z, credit_access, se_indicator, y = make_data()
+    model = make_model()
+    XZ, credit_se = prepare_inputs(X, Z, credit_access, se_indicator)
+    closure_rate = 0.5
+
+    result = counterfactual_analysis(model, XZ, credit_se, closure_rate)
+    result_reused = counterfactual_analysis(model, XZ, credit_se, closure_rate,
+                                            base=counterfactual_base(model, XZ))
+    assert result == result_reused
+
+    # Original formulation: two full FP32 forward passes, the second with
+    # branch credit access scaled down
+    credit_cf = credit_access.clone()
+    credit_cf[:, BRANCH_ALTS] *= (1 - closure_rate)
+    with torch.no_grad():
+        V_base, _ = reference_utilities(model, X, Z, credit_access, se_indicator)
+        V_cf, _ = reference_utilities(model, X, Z, credit_cf, se_indicator)
+    se_rate_base = torch.softmax(V_base, dim=1)[:, SE_ALTS].sum(dim=1).mean().item()
+    se_rate_cf = torch.softmax(V_cf, dim=1)[:, SE_ALTS].sum(dim=1).mean().item()
+    effect = (se_rate_cf - se_rate_base) / se_rate_base * 100
+
+    # TasteNet runs in BF16 in counterfactual_base, so allow for its rounding
+    assert result[0] == pytest.approx(se_rate_base, abs=1e-4)
+    assert result[1] == pytest.approx(se_rate_cf, abs=1e-4)
+    assert result[2] == pytest.approx(effect, rel=1e-2)
+
+
+def test_train_smoke_small_sample_no_improvement(tmp_path, capsys):
+    X, Z, credit_access, se_indicator, y = make_data(n=50)
+    model = make_model()
+    XZ, credit_se = prepare_inputs(X, Z, credit_access, se_indicator)
+    train_data, val_data = split_data(XZ, credit_se, y)
+
+    # NaN validation loss never improves, so best_state stays None
+    XZ_val, credit_se_val, y_val = val_data
+    XZ_val = XZ_val.clone()
+    XZ_val[0, 0] = float('nan')
+
+    save_path = tmp_path / 'model.pt'
+    train_tastenet_mnl(model, train_data, (XZ_val, credit_se_val, y_val),
+                       epochs=3, batch_size=256, save_path=save_path)  # > n_train
+
+    assert 'validation loss never improved' in capsys.readouterr().out
+    assert all(torch.isfinite(p).all() for p in model.parameters())
+
+    reloaded = TasteNetMNL(N_ALTERNATIVES, X.shape[1], Z.shape[1])
+    reloaded.load_state_dict(torch.load(save_path))
+    for k, v in model.state_dict().items():
+        torch.testing.assert_close(reloaded.state_dict()[k], v)